@@ -5,6 +5,15 @@ __getattr__, __dir__, __all__ = lazy.attach(
     # submodules=['strategies', 'histManipulate', 'run_HistMaker', 'run_PlotMaker'],
     submod_attrs={
         'version': ['__version__'],
-        'histmaker': ['Graph', 'SSRLHisto1D', 'AvgGraph', 'SSRLHistMaker'],
+        'histmaker': [
+            'Graph',
+            'SSRLHisto1D',
+            'MultiWeightHisto1D',
+            'AvgGraph',
+            'SSRLHistMaker',
+        ],
+        'waveform': ['WaveformFeatures'],
+        'cutflow': ['Cutflow'],
+        'workqueue': ['WorkQueue', 'run_worker'],
     },
 )
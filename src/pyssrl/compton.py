@@ -1,4 +1,8 @@
 import numpy as np
+import numba
+import math
+import copy
+import functools
 import matplotlib.pyplot as plt
 
 ELECTRON_REST_MASS = 5.11e5  # eV
@@ -113,7 +117,7 @@ def from_photoelectric(photon_e, nevents):
     return tot_evts, compton_evts
 
 
-def _kn_recoil_sampling(photon_e, acceptance_angles=None):
+def _kn_recoil_sampling(photon_e, acceptance_angles=None, rng=None):
     kappa = photon_e / ELECTRON_REST_MASS
     epsilon_0 = 1.0 / (1.0 + 2.0 * kappa)
     alpha1 = np.log(1 / epsilon_0)
@@ -121,10 +125,12 @@ def _kn_recoil_sampling(photon_e, acceptance_angles=None):
     alpha_sum = alpha1 + alpha2
     alpha1_frac = alpha1 / alpha_sum
     # alpha2_frac = alpha2 / alpha_sum
-    rv_a = np.random.default_rng().uniform(0, 1)
-    rv_b = np.random.default_rng().uniform(0, 1)
-    rv_c = np.random.default_rng().uniform(0, 1)
-    sign = np.random.choice([-1, 1])
+    if rng is None:
+        rng = np.random.default_rng()
+    rv_a = rng.uniform(0, 1)
+    rv_b = rng.uniform(0, 1)
+    rv_c = rng.uniform(0, 1)
+    sign = rng.choice([-1, 1])
     if rv_a < alpha1_frac:
         epsilon = np.exp(-np.log(1 / epsilon_0) * rv_b)
     else:
@@ -158,12 +164,13 @@ def _kn_recoil_sampling(photon_e, acceptance_angles=None):
 
 
 def kn_recoil_sampling(
-    photon_e, N=int(1e4), acceptance_angles=None, include_angles=False
+    photon_e, N=int(1e4), acceptance_angles=None, include_angles=False, seed=None
 ):
+    rng = np.random.default_rng(seed)
     recoils = np.empty(N)
     angles = np.empty(N)
     for i in range(N):
-        r_e, r_a = _kn_recoil_sampling(photon_e, acceptance_angles)
+        r_e, r_a = _kn_recoil_sampling(photon_e, acceptance_angles, rng)
         recoils[i] = r_e
         angles[i] = r_a
     mask = recoils != -1
@@ -173,6 +180,151 @@ def kn_recoil_sampling(
         return recoils[mask]
 
 
+@numba.vectorize(["float64(float64)"])
+def _norm_cdf(x):
+    return 0.5 * (1.0 + math.erf(x / math.sqrt(2.0)))
+
+
+def recoil_electron_angle(photon_e, recoil_e):
+    '''
+    inverse of recoil_electron_energy, scattering angle in [0, pi] of the
+    photon giving recoil_e (eV) to the electron.
+    '''
+    epsilon = photon_e / ELECTRON_REST_MASS
+    recoil_e = np.clip(recoil_e, 0.0, photon_e * 2 * epsilon / (1 + 2 * epsilon))
+    cos_angle = 1.0 - recoil_e / (epsilon * (photon_e - recoil_e))
+    return np.arccos(np.clip(cos_angle, -1.0, 1.0))
+
+
+def compton_bin_xsec(photon_e, edges, acceptance_angles=None, npoints=16):
+    '''
+    Klein-Nishina cross section (barn, per electron) of the recoil electron
+    energy within each interval of edges (eV), integrated by Gauss-Legendre
+    quadrature over the photon angles in acceptance_angles.
+
+    acceptance_angles follows kn_recoil_sampling, i.e. (low, high) of signed
+    angle where both signs are equally likely.
+    '''
+    edges = np.asarray(edges, dtype=float)
+    angles = recoil_electron_angle(photon_e, edges)
+    if acceptance_angles is None:
+        windows = [(0.0, np.pi, 1.0)]
+    else:
+        low, high = acceptance_angles
+        windows = [(max(low, 0.0), min(high, np.pi), 0.5)]
+        windows.append((max(-high, 0.0), min(-low, np.pi), 0.5))
+    nodes, weights = np.polynomial.legendre.leggauss(npoints)
+    xsec = np.zeros(len(edges) - 1)
+    for w_low, w_high, frac in windows:
+        a = np.clip(angles[:-1], w_low, w_high)
+        b = np.clip(angles[1:], w_low, w_high)
+        half = 0.5 * (b - a)
+        theta = (a + b)[:, None] * 0.5 + half[:, None] * nodes
+        integrand = klein_nishina(photon_e, theta) * 2 * np.pi * np.sin(theta)
+        xsec += frac * half * (integrand @ weights)
+    return xsec
+
+
+def _smeared_cdf(low, high, x, resolution):
+    '''
+    probability of the measured energy to be below x for true energy uniformly
+    distributed in [low, high] and Gaussian resolution. low and high are
+    column vectors, x is row vector.
+    '''
+    width = high - low
+    if resolution <= 0:
+        return np.clip((x - low) / width, 0.0, 1.0)
+
+    def integral(u):
+        z = u / resolution
+        return u * _norm_cdf(z) + resolution * np.exp(-0.5 * z**2) / np.sqrt(2 * np.pi)
+
+    return (integral(x - low) - integral(x - high)) / width
+
+
+@functools.lru_cache(maxsize=128)
+def _compton_template_content(
+    photon_e, edges, acceptance_angles, resolution, energy_unit, photoelectric, Z
+):
+    edges = np.asarray(edges) * energy_unit
+    resolution = resolution * energy_unit
+    epsilon = photon_e / ELECTRON_REST_MASS
+    max_recoil = photon_e * 2 * epsilon / (1 + 2 * epsilon)
+
+    # the spectrum is integrated exactly on a fine grid covering all recoil
+    # energies, and taken as constant within each interval for smearing.
+    grid = np.linspace(0.0, max_recoil, 512)
+    grid = np.unique(np.concatenate([grid, np.clip(edges, 0.0, max_recoil)]))
+    xsec = compton_bin_xsec(photon_e, grid, acceptance_angles)
+    total_xsec = compton_bin_xsec(photon_e, [0.0, max_recoil])[0]
+
+    ph = photoelectric_xsec(photon_e, Z)
+    compton = compton_xsec(photon_e, Z)
+    compton_frac = compton / (ph + compton)
+    ph_frac = ph / (ph + compton)
+
+    # cumulative probability at each edge, with underflow and overflow.
+    cdf = _smeared_cdf(grid[:-1, None], grid[1:, None], edges[None, :], resolution)
+    cdf = compton_frac * (xsec / total_xsec) @ cdf
+    total = compton_frac * np.sum(xsec) / total_xsec
+    if photoelectric:
+        if resolution > 0:
+            cdf = cdf + ph_frac * _norm_cdf((edges - photon_e) / resolution)
+        else:
+            cdf = cdf + ph_frac * (edges > photon_e)
+        total += ph_frac
+    content = np.diff(np.concatenate([[0.0], cdf, [total]]))
+    # remove round-off below zero in bins without any recoil.
+    content = np.clip(content, 0.0, None)
+    content.flags.writeable = False
+    return content
+
+
+def compton_template(
+    photon_e,
+    hist,
+    acceptance_angles=None,
+    resolution=0.0,
+    energy_unit=1.0,
+    photoelectric=True,
+    Z=14,
+    norm=1.0,
+):
+    '''
+    Expected recoil energy spectrum per interacting photon, binned as the
+    given histogram.
+
+    photon_e (float) : incoming photon energy in eV.
+    hist : collinearw.Histogram providing the binning, in units of
+        energy_unit eV.
+    acceptance_angles : (low, high) photon angles in radian, see
+        kn_recoil_sampling.
+    resolution (float) : Gaussian detector resolution in units of the
+        histogram.
+    photoelectric (bool) : include the photoelectric peak at photon_e. The
+        Compton and photoelectric parts are weighted by their cross sections.
+
+    return:
+        copy of hist filled with the template scaled by norm. Templates are
+        cached per energy, binning and resolution.
+    '''
+    if acceptance_angles is not None:
+        acceptance_angles = tuple(float(x) for x in acceptance_angles)
+    content = _compton_template_content(
+        float(photon_e),
+        tuple(float(x) for x in hist.bins),
+        acceptance_angles,
+        float(resolution),
+        float(energy_unit),
+        bool(photoelectric),
+        Z,
+    )
+    template = copy.deepcopy(hist)
+    template.bin_content = norm * content
+    template.sumW2 = np.zeros_like(content)
+    return template
+
+
 if __name__ == "__main__":
     # inc_e = 35e3
     # recoils = []
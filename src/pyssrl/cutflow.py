@@ -0,0 +1,225 @@
+import numbers
+import logging
+import numpy as np
+import awkward as ak
+from tabulate import tabulate
+from awkward._connect import numexpr
+
+log = logging.getLogger(__name__)
+
+ne_evaluate = numexpr.evaluate
+
+# bits available in the per-event cut bitmap. one bit is kept free so the
+# number of trailing ones can always be found from the complement.
+MAX_CUTS = 63
+
+
+def _strip_parentheses(expr):
+    '''
+    remove parentheses enclosing the whole expression, e.g. ((a>1)) -> a>1
+    '''
+    expr = expr.strip()
+    while expr.startswith("(") and expr.endswith(")"):
+        depth = 0
+        for i, c in enumerate(expr):
+            if c == "(":
+                depth += 1
+            elif c == ")":
+                depth -= 1
+            if depth == 0 and i != len(expr) - 1:
+                return expr
+        expr = expr[1:-1].strip()
+    return expr
+
+
+def split_selection(selection):
+    '''
+    split selection string into ordered list of sub-cuts on the top level '&'.
+    selection with top level '|' is kept as a single cut.
+    '''
+    if not selection:
+        return []
+    selection = _strip_parentheses(selection)
+    cuts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(selection):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return [selection]
+        elif c == "&" and depth == 0:
+            cuts.append(selection[start:i])
+            start = i + 1
+    cuts.append(selection[start:])
+    cuts = [_strip_parentheses(cut) for cut in cuts]
+    return [cut for cut in cuts if cut]
+
+
+def _event_mask(mask, nevent):
+    '''
+    reduce a selection result to boolean numpy array of per event.
+    '''
+    if isinstance(mask, ak.Array):
+        if mask.ndim > 1:
+            mask = ak.any(mask, axis=1)
+        return ak.to_numpy(mask).astype(bool)
+    if np.ndim(mask) == 0:
+        return np.full(nevent, bool(mask))
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim > 1:
+        mask = np.any(mask, axis=1)
+    return mask
+
+
+def _event_weights(weights, nevent):
+    '''
+    reduce weights to float numpy array of per event. Jagged weights are
+    taken from the first object of each event.
+    '''
+    if weights is None:
+        return np.ones(nevent)
+    if isinstance(weights, ak.Array):
+        if weights.ndim > 1:
+            weights = ak.fill_none(ak.firsts(weights), 0.0)
+        return ak.to_numpy(weights).astype(np.float64)
+    if isinstance(weights, numbers.Number) or np.ndim(weights) == 0:
+        return np.full(nevent, float(weights))
+    return np.asarray(weights, dtype=np.float64)
+
+
+class Cutflow:
+    '''
+    Cutflow and region overlap accounting.
+
+    For each process and region, the process and region selections are split
+    into ordered sub-cuts. Per chunk, the sub-cut results are packed into a
+    per-event bitmap, and the number of consecutive cuts an event passes is
+    obtained with bit operations, so every row of the cutflow is accumulated
+    with one bincount. Counting is done per event, i.e. an event passes the
+    first k cuts if any object passes all of them.
+    '''
+
+    def __init__(self):
+        # {process: {region: list of cut labels}}
+        self.cuts = {}
+        # {process: {region: (raw counts, sum of weights, sum of weights^2)}}
+        self.counts = {}
+        # {process: (region names, overlap matrix of raw counts)}
+        self.overlaps = {}
+
+    def fill(self, p, event, weights=None):
+        '''
+        p : collinearw.Process
+        event : awkward array of the chunk.
+        weights : optional {region name : weights}
+        '''
+        weights = weights or {}
+        nevent = len(event)
+        cut_masks = {}
+        p_cuts = split_selection(p.selection_numexpr)
+        region_names = []
+        members = np.zeros((nevent, len(p.regions)), dtype=np.int64)
+        p_cutflow = self.cuts.setdefault(p.name, {})
+        p_counts = self.counts.setdefault(p.name, {})
+        for j, r in enumerate(p.regions):
+            cuts = p_cuts + split_selection(r.selection_numexpr)
+            if len(cuts) > MAX_CUTS:
+                raise ValueError(f"{r.name} has more than {MAX_CUTS} cuts.")
+            if p_cutflow.setdefault(r.name, cuts) != cuts:
+                raise ValueError(f"Selection of {p.name}/{r.name} has changed.")
+            bitmap = np.zeros(nevent, dtype=np.uint64)
+            cumulative = None
+            for i, cut in enumerate(cuts):
+                if cut not in cut_masks:
+                    cut_masks[cut] = ne_evaluate(cut, event)
+                # cuts are combined at object level before the reduction per
+                # event, as the region mask used for filling.
+                if cumulative is None:
+                    cumulative = cut_masks[cut]
+                else:
+                    cumulative = cumulative & cut_masks[cut]
+                passed = _event_mask(cumulative, nevent)
+                bitmap |= passed.astype(np.uint64) << np.uint64(i)
+            # number of trailing ones, i.e. consecutive cuts passed.
+            inv = ~bitmap
+            npass = np.log2(inv & (~inv + np.uint64(1))).astype(np.int64)
+
+            w = _event_weights(weights.get(r.name), nevent)
+            nrow = len(cuts) + 1
+            raw = np.bincount(npass, minlength=nrow)
+            sumw = np.bincount(npass, weights=w, minlength=nrow)
+            sumw2 = np.bincount(npass, weights=w**2, minlength=nrow)
+            # events stopped at cut k pass all rows up to k.
+            chunk = [x[::-1].cumsum()[::-1] for x in (raw, sumw, sumw2)]
+            if r.name in p_counts:
+                chunk = [a + b for a, b in zip(p_counts[r.name], chunk)]
+            p_counts[r.name] = tuple(chunk)
+
+            members[:, j] = npass == len(cuts)
+            region_names.append(r.name)
+
+        overlap = members.T @ members
+        if p.name in self.overlaps:
+            if self.overlaps[p.name][0] != region_names:
+                raise ValueError(f"Regions of {p.name} have changed.")
+            overlap = overlap + self.overlaps[p.name][1]
+        self.overlaps[p.name] = (region_names, overlap)
+
+    def add(self, rhs):
+        for pname, regions in rhs.cuts.items():
+            p_cutflow = self.cuts.setdefault(pname, {})
+            p_counts = self.counts.setdefault(pname, {})
+            for rname, cuts in regions.items():
+                if p_cutflow.setdefault(rname, cuts) != cuts:
+                    raise ValueError(f"Cuts of {pname}/{rname} do not match.")
+                counts = rhs.counts[pname][rname]
+                if rname in p_counts:
+                    counts = [a + b for a, b in zip(p_counts[rname], counts)]
+                p_counts[rname] = tuple(counts)
+        for pname, (names, overlap) in rhs.overlaps.items():
+            if pname in self.overlaps:
+                if self.overlaps[pname][0] != names:
+                    raise ValueError(f"Regions of {pname} do not match.")
+                overlap = overlap + self.overlaps[pname][1]
+            self.overlaps[pname] = (list(names), overlap)
+
+    def __add__(self, rhs):
+        c_self = Cutflow()
+        c_self.add(self)
+        c_self.add(rhs)
+        return c_self
+
+    def rows(self, process, region):
+        '''
+        return list of (cut, raw, sumw, error, efficiency w.r.t previous cut)
+        '''
+        cuts = ["all"] + self.cuts[process][region]
+        raw, sumw, sumw2 = self.counts[process][region]
+        rows = []
+        for i, cut in enumerate(cuts):
+            prev = sumw[i - 1] if i else sumw[i]
+            eff = sumw[i] / prev if prev else np.nan
+            rows.append((cut, int(raw[i]), sumw[i], np.sqrt(sumw2[i]), eff))
+        return rows
+
+    def table(self, process, region, tablefmt="simple"):
+        return tabulate(
+            self.rows(process, region),
+            headers=["cut", "raw", "weighted", "error", "efficiency"],
+            tablefmt=tablefmt,
+        )
+
+    def overlap(self, process):
+        '''
+        return region names and the matrix of number of events shared by each
+        pair of regions. The diagonal is the number of events in the region.
+        '''
+        return self.overlaps[process]
+
+    def overlap_table(self, process, tablefmt="simple"):
+        names, overlap = self.overlaps[process]
+        rows = [[name] + list(row) for name, row in zip(names, overlap)]
+        return tabulate(rows, headers=[""] + names, tablefmt=tablefmt)
@@ -7,6 +7,7 @@ import numpy as np
 import logging
 import copy
 import numbers
+import zlib
 from awkward._connect import numexpr
 
 
@@ -16,8 +17,31 @@ ne_evaluate = numexpr.evaluate
 
 
 class Graph(HistogramBase):
-    def __init__(self, name, x, y, xtitle, ytitle, type, filter_type=None):
+    """
+    Collection of waveforms.
+
+    sampling="first" keeps the first `limit` waveforms. sampling="reservoir"
+    keeps a uniform random sample of `limit` waveforms over the whole stream:
+    each waveform is given a random key, and the `limit` smallest keys are
+    kept, so reservoirs from different files or workers can be merged. The
+    keys are seeded by `seed` and the position of the chunk in the file.
+    """
+
+    def __init__(
+        self,
+        name,
+        x,
+        y,
+        xtitle,
+        ytitle,
+        type,
+        filter_type=None,
+        sampling="first",
+        seed=None,
+    ):
         super().__init__(name)
+        if sampling not in ("first", "reservoir"):
+            raise ValueError(f"Unknown sampling {sampling}")
         self.xvar = x
         self.yvar = y
         self.xtitle = xtitle
@@ -30,6 +54,11 @@ class Graph(HistogramBase):
         self.reach_limit = False
         self.filter_type = filter_type
         self.action_before_fill = None
+        self.sampling = sampling
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.keys = np.empty(0)
 
     def __copy__(self):
         c_self = super().__copy__()
@@ -43,6 +72,9 @@ class Graph(HistogramBase):
         c_self.reach_limit = self.reach_limit
         c_self.filter_type = self.filter_type
         c_self.action_before_fill = self.action_before_fill
+        c_self.sampling = self.sampling
+        c_self.seed = self.seed
+        c_self.keys = self.keys
         c_self.xdata = copy.copy(self.xdata)
         c_self.ydata = copy.copy(self.ydata)
         return c_self
@@ -59,6 +91,9 @@ class Graph(HistogramBase):
         c_self.reach_limit = self.reach_limit
         c_self.filter_type = self.filter_type
         c_self.action_before_fill = self.action_before_fill
+        c_self.sampling = self.sampling
+        c_self.seed = self.seed
+        c_self.keys = copy.deepcopy(self.keys, memo)
         c_self.xdata = copy.deepcopy(self.xdata, memo)
         c_self.ydata = copy.deepcopy(self.ydata, memo)
         return c_self
@@ -67,6 +102,10 @@ class Graph(HistogramBase):
         return copy.deepcopy(self)
 
     def add(self, rhs):
+        if self.sampling == "reservoir":
+            self.counter += rhs.counter
+            self._keep(rhs.keys, rhs.xdata, rhs.ydata)
+            return
         self.xdata = self.xdata + rhs.xdata
         self.ydata = self.ydata + rhs.ydata
 
@@ -87,7 +126,10 @@ class Graph(HistogramBase):
     def ndata(self):
         return len(self.xdata)
 
-    def from_array(self, xdata, ydata):
+    def from_array(self, xdata, ydata, stream=None):
+        if self.sampling == "reservoir":
+            self._reservoir_fill(xdata, ydata, stream)
+            return
         if self.counter == self.limit:
             self.reach_limit = True
             return
@@ -101,6 +143,51 @@ class Graph(HistogramBase):
             self.ydata.append(y.to_numpy())
             self.counter += 1
 
+    def _keep(self, keys, xdata, ydata):
+        """
+        merge candidates into the reservoir, keeping the smallest keys.
+        """
+        keys = np.concatenate([self.keys, keys])
+        xdata = self.xdata + list(xdata)
+        ydata = self.ydata + list(ydata)
+        if len(keys) > self.limit:
+            keep = np.sort(np.argpartition(keys, self.limit - 1)[: self.limit])
+            keys = keys[keep]
+            xdata = [xdata[i] for i in keep]
+            ydata = [ydata[i] for i in keep]
+        self.keys = keys
+        self.xdata = xdata
+        self.ydata = ydata
+
+    def _reservoir_fill(self, xdata, ydata, stream=None):
+        """
+        stream : tuple of non-negative int identifying the chunk, e.g.
+            (file hash, entry start). Default to the number of items seen.
+        """
+        flatten = self.action_before_fill == "flatten"
+        nitem = 1 if flatten else len(xdata)
+        if stream is None:
+            stream = (self.counter,)
+        keys = np.random.default_rng([self.seed, *stream]).random(nitem)
+        self.counter += nitem
+        # only the keys smaller than the current largest one can enter a full
+        # reservoir. skip the chunk without touching the waveforms otherwise.
+        if len(self.keys) >= self.limit:
+            win = np.flatnonzero(keys < self.keys.max())
+            if len(win) == 0:
+                return
+        else:
+            win = np.arange(nitem)
+        if len(win) > self.limit:
+            win = win[np.argpartition(keys[win], self.limit - 1)[: self.limit]]
+        if flatten:
+            new_x = [ak.flatten(xdata).to_numpy()]
+            new_y = [ak.flatten(ydata).to_numpy()]
+        else:
+            new_x = [x.to_numpy() for x in xdata[win]]
+            new_y = [y.to_numpy() for y in ydata[win]]
+        self._keep(keys[win], new_x, new_y)
+
 
 class SSRLHisto1D(Histogram):
     def __init__(self, *args, selection=None, **kwargs):
@@ -128,7 +215,122 @@ class SSRLHisto1D(Histogram):
         # super().from_array(data)
 
 
+class MultiWeightHisto1D(Histogram):
+    """
+    1D histogram carrying named weight variations.
+
+    The variations are given as {name: expression}, and each expression is
+    evaluated as a multiplicative factor on top of the nominal weight. The
+    sum of weights and sum of weights squared of all the variations are
+    stored as an extra leading axis in variation_content and variation_sumW2,
+    and are filled together with a single bin index computation.
+    """
+
+    def __init__(self, *args, weight_variations=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.weight_variations = dict(weight_variations or {})
+        shape = (len(self.weight_variations), len(self.bins) + 1)
+        self.variation_content = np.zeros(shape)
+        self.variation_sumW2 = np.zeros(shape)
+
+    def __copy__(self):
+        c_self = super().__copy__()
+        c_self.weight_variations = self.weight_variations
+        c_self.variation_content = self.variation_content
+        c_self.variation_sumW2 = self.variation_sumW2
+        return c_self
+
+    def __deepcopy__(self, memo):
+        c_self = super().__deepcopy__(memo)
+        c_self.weight_variations = copy.deepcopy(self.weight_variations, memo)
+        c_self.variation_content = copy.deepcopy(self.variation_content, memo)
+        c_self.variation_sumW2 = copy.deepcopy(self.variation_sumW2, memo)
+        return c_self
+
+    def add(self, rhs):
+        super().add(rhs)
+        self.variation_content = self.variation_content + rhs.variation_content
+        self.variation_sumW2 = self.variation_sumW2 + rhs.variation_sumW2
+
+    @property
+    def variation_names(self):
+        return list(self.weight_variations)
+
+    def variation(self, name):
+        """
+        return a copy of the nominal histogram filled with given variation.
+        """
+        index = self.variation_names.index(name)
+        c_self = copy.deepcopy(self)
+        c_self.bin_content = self.variation_content[index].copy()
+        c_self.sumW2 = self.variation_sumW2[index].copy()
+        return c_self
+
+    def variation_factors(self, event, cache=None):
+        """
+        evaluate the factor of each variation on the chunk. Numeric expressions
+        are kept as float, since numexpr cannot evaluate constants on awkward
+        arrays. cache : optional {expression : factor} shared within a chunk.
+        """
+        if cache is None:
+            cache = {}
+        factors = []
+        for expr in self.weight_variations.values():
+            if expr not in cache:
+                try:
+                    factor = float(expr)
+                except ValueError:
+                    factor = ne_evaluate(expr, event)
+                    if getattr(factor, "ndim", 0) > 1:
+                        factor = ak.flatten(factor)
+                cache[expr] = factor
+            factors.append(cache[expr])
+        return factors
+
+    def from_array(self, data, w=None, variations=None):
+        """
+        data : observable values.
+        w : nominal weights, None, scalar or array matching data.
+        variations : list of factors (scalar or array matching data), one per
+            entry of weight_variations. Default to factor 1 for all.
+        """
+        data = ak.to_numpy(data) if isinstance(data, ak.Array) else np.asarray(data)
+        nvar, nbin = self.variation_content.shape
+        if variations is None:
+            variations = [1.0] * nvar
+        elif len(variations) != nvar:
+            raise ValueError(
+                f"{self.name} expects {nvar} weight variations, got {len(variations)}"
+            )
+        # row 0 is the nominal, followed by the variations.
+        fill_w = np.ones((nvar + 1, len(data)))
+        for i, factor in enumerate(variations):
+            if isinstance(factor, ak.Array):
+                factor = ak.to_numpy(factor)
+            fill_w[i + 1] = factor
+        if w is not None:
+            fill_w *= ak.to_numpy(w) if isinstance(w, ak.Array) else w
+        # shift the bin index of each row to its own block, so that the
+        # nominal and all variations are filled by one bincount.
+        index = np.digitize(data, self.bins)
+        index = (index + nbin * np.arange(nvar + 1)[:, None]).ravel()
+        fill_w = fill_w.ravel()
+        sumw = np.bincount(index, weights=fill_w, minlength=(nvar + 1) * nbin)
+        sumw2 = np.bincount(index, weights=fill_w**2, minlength=(nvar + 1) * nbin)
+        sumw = sumw.reshape(nvar + 1, nbin)
+        sumw2 = sumw2.reshape(nvar + 1, nbin)
+        self.bin_content = self.bin_content + sumw[0]
+        self.sumW2 = self.sumW2 + sumw2[0]
+        self.variation_content += sumw[1:]
+        self.variation_sumW2 += sumw2[1:]
+
+
 class AvgGraph(Graph):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # waveforms are summed, there is no sample to draw.
+        if self.sampling != "first":
+            raise ValueError(f"AvgGraph does not support sampling={self.sampling}")
 
     @property
     def hist_type(self):
@@ -164,6 +366,51 @@ class SSRLHistMaker(HistMaker):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.histogram_1d_alias = []
+        # stages (e.g. WaveformFeatures) that attach virtual branches to
+        # each chunk before any selection is evaluated.
+        self.feature_stages = []
+        # optional Cutflow instance, accumulating the cutflow of every region.
+        self.cutflow = None
+        # optional callable without argument, called at every chunk. e.g. to
+        # renew the lease of a WorkQueue shard.
+        self.progress_callback = None
+
+    def add_feature_stage(self, stage):
+        self.feature_stages.append(stage)
+
+    def region_weights(self, r, event, process_weights=None):
+        # obtaining process and region level weights
+        # if none of them were found, try to use the
+        # histmaker default weight. i.e self.default_weight
+        weights = None
+        if process_weights is None and r.weights is None:
+            if self.default_weight:
+                weights = ne_evaluate(self.default_weight, event)
+        else:
+            if process_weights:
+                weights = ne_evaluate(process_weights, event)
+            if r.weights:
+                if isinstance(r.weights, list):
+                    for w in r.weights:
+                        if weights is None:
+                            weights = event[w]
+                        else:
+                            weights *= event[w]
+                elif str.isnumeric(r.weights):
+                    if weights is None:
+                        weights = float(r.weights)
+                    else:
+                        weights *= float(r.weights)
+                else:
+                    mul_w = ne_evaluate(r.weights, event)
+                    if weights is None:
+                        weights = mul_w
+                    else:
+                        weights *= mul_w
+            # check if user enforce to use default weight
+            if self.enforce_default_weight and self.default_weight:
+                weights *= ne_evaluate(self.default_weight, event)
+        return weights
 
     def plevel_process(self, p, file_name, *, branch_list=None):
         with self.open_file(file_name) as tfile:
@@ -199,6 +446,14 @@ class SSRLHistMaker(HistMaker):
                     branch_filter.discard(new_bname)
                     branch_filter.add(old_bname)
 
+            # virtual branches are computed from the inputs of feature stages,
+            # so only the inputs need to be read from the file.
+            if branch_filter is not None and self.feature_stages:
+                branch_filter = set(branch_filter)
+                for stage in self.feature_stages:
+                    branch_filter -= stage.output_branches
+                    branch_filter |= stage.input_branches
+
             with tqdm(
                 desc=f"Processing {p.name}",
                 total=ttree.num_entries,
@@ -214,8 +469,29 @@ class SSRLHistMaker(HistMaker):
                     # library="np",
                 ):
                     nevent = report.tree_entry_stop - report.tree_entry_start
+                    if self.progress_callback is not None:
+                        self.progress_callback()
                     pbar_events.set_description(f"Processing {nevent} events")
 
+                    for stage in self.feature_stages:
+                        event = stage(event)
+
+                    # identify the chunk for the seeding of Graph sampling.
+                    stream = (
+                        zlib.crc32(str(file_name).encode()),
+                        report.tree_entry_start,
+                    )
+
+                    # weights of each region, evaluated once per chunk and shared
+                    # by the cutflow and the histogram filling.
+                    chunk_weights = {}
+                    if self.cutflow is not None:
+                        for r in p.regions:
+                            chunk_weights[r.name] = self.region_weights(
+                                r, event, process_weights
+                            )
+                        self.cutflow.fill(p, event, chunk_weights)
+
                     # all_mask is a mask with only process level selection
                     # if no process level seletion, accept all events.
                     # the mask is array of True/False.
@@ -228,6 +504,10 @@ class SSRLHistMaker(HistMaker):
                     else:
                         all_mask = None  # ak.ones_like(event)
 
+                    # weight variation factors, evaluated once per chunk and
+                    # shared by all regions and histograms.
+                    variation_cache = {}
+
                     pbar_regions = tqdm(
                         p.regions,
                         leave=False,
@@ -264,37 +544,11 @@ class SSRLHistMaker(HistMaker):
                             )
                             mask = all_mask
 
-                        # obtaining process and region level weights
-                        # if none of them were found, try to use the
-                        # histmaker default weight. i.e self.default_weight
-                        weights = None
-                        if process_weights is None and r.weights is None:
-                            if self.default_weight:
-                                weights = ne_evaluate(self.default_weight, event)
-                        else:
-                            if process_weights:
-                                weights = ne_evaluate(process_weights, event)
-                            if r.weights:
-                                if isinstance(r.weights, list):
-                                    for w in r.weights:
-                                        if weights is None:
-                                            weights = event[w]
-                                        else:
-                                            weights *= event[w]
-                                elif str.isnumeric(r.weights):
-                                    if weights is None:
-                                        weights = float(r.weights)
-                                    else:
-                                        weights *= float(r.weights)
-                                else:
-                                    mul_w = ne_evaluate(r.weights, event)
-                                    if weights is None:
-                                        weights = mul_w
-                                    else:
-                                        weights *= mul_w
-                            # check if user enforce to use default weight
-                            if self.enforce_default_weight and self.default_weight:
-                                weights *= ne_evaluate(self.default_weight, event)
+                        if r.name not in chunk_weights:
+                            chunk_weights[r.name] = self.region_weights(
+                                r, event, process_weights
+                            )
+                        weights = chunk_weights[r.name]
 
                         if mask is None:
                             m_mask = None
@@ -344,9 +598,9 @@ class SSRLHistMaker(HistMaker):
                                     xdata = xdata[ak.any(mask, axis=1)]
                                     ydata = ydata[ak.any(mask, axis=1)]
                                 if ak.any(xdata) and ak.any(ydata):
-                                    hist.from_array(xdata, ydata)
+                                    hist.from_array(xdata, ydata, stream)
                                 if hist.reach_limit:
-                                    SSRLHistMaker.early_termination_counter += 1
+                                    self.early_termination_counter += 1
                             elif hist.hist_type == "avg-graph":
                                 xobs, yobs = hist.observable
                                 try:
@@ -363,6 +617,23 @@ class SSRLHistMaker(HistMaker):
                                         ydata = ydata[ak.any(mask, axis=1)]
                                 if ak.any(xdata) and ak.any(ydata):
                                     hist.from_array(xdata, ydata)
+                            elif isinstance(hist, MultiWeightHisto1D):
+                                obs = hist.observable[0]
+                                data = ne_evaluate(obs, event)
+                                if data.ndim != 1:
+                                    data = ak.flatten(data)
+                                factors = hist.variation_factors(event, variation_cache)
+                                histw = w
+                                if m_mask is not None:
+                                    data = data[m_mask]
+                                    if w is not None:
+                                        histw = w[m_mask]
+                                    factors = [
+                                        f[m_mask] if getattr(f, "ndim", 0) else f
+                                        for f in factors
+                                    ]
+                                if ak.any(data):
+                                    hist.from_array(data, histw, factors)
                             elif isinstance(hist, SSRLHisto1D):
                                 hist.from_array(event, mask, w)
                             else:
@@ -376,7 +647,7 @@ class SSRLHistMaker(HistMaker):
                                     hist.from_array(data, w)
 
                     pbar_events.update(nevent)
-                    if SSRLHistMaker.early_termination_counter > 20:
+                    if self.early_termination_counter > 20:
                         return p
 
         return p
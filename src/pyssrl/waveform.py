@@ -0,0 +1,172 @@
+import awkward as ak
+import numpy as np
+import numba
+import logging
+
+
+log = logging.getLogger(__name__)
+
+# order of the columns returned by the feature kernel.
+FEATURES = ("baseline", "rms", "amp", "toa", "risetime", "charge")
+
+
+@numba.njit
+def _cross_time(time, volt, start, peak, level):
+    '''
+    walk backward from the peak until the (baseline subtracted) pulse drops
+    below level, and linearly interpolate the crossing time.
+    '''
+    for j in range(peak, start, -1):
+        if volt[j - 1] < level:
+            dv = volt[j] - volt[j - 1]
+            if dv == 0:
+                return time[j]
+            return time[j - 1] + (level - volt[j - 1]) * (time[j] - time[j - 1]) / dv
+    return np.nan
+
+
+@numba.njit
+def _waveform_features(
+    time, volt, offsets, polarity, nbaseline, cfd_fraction, rise_low, rise_high
+):
+    '''
+    compute the pulse features of every waveform in the flattened time and
+    voltage contents. The i-th waveform spans offsets[i] to offsets[i+1].
+    '''
+    nwave = len(offsets) - 1
+    output = np.full((nwave, 6), np.nan)
+    for i in range(nwave):
+        start = offsets[i]
+        stop = offsets[i + 1]
+        if stop - start < 2:
+            continue
+        nbase = min(nbaseline, stop - start)
+        baseline = 0.0
+        for j in range(start, start + nbase):
+            baseline += volt[j]
+        baseline /= nbase
+        rms = 0.0
+        for j in range(start, start + nbase):
+            rms += (volt[j] - baseline) ** 2
+        rms = np.sqrt(rms / nbase)
+
+        # pulse in positive polarity with baseline removed.
+        pulse = np.empty(stop - start)
+        for j in range(start, stop):
+            pulse[j - start] = polarity * (volt[j] - baseline)
+        t = time[start:stop]
+
+        peak = 0
+        for j in range(1, stop - start):
+            if pulse[j] > pulse[peak]:
+                peak = j
+        amp = pulse[peak]
+
+        charge = 0.0
+        for j in range(1, stop - start):
+            charge += 0.5 * (pulse[j] + pulse[j - 1]) * (t[j] - t[j - 1])
+
+        output[i, 0] = baseline
+        output[i, 1] = rms
+        output[i, 2] = amp
+        output[i, 5] = charge
+        if amp <= 0:
+            continue
+        output[i, 3] = _cross_time(t, pulse, 0, peak, cfd_fraction * amp)
+        output[i, 4] = _cross_time(t, pulse, 0, peak, rise_high * amp) - _cross_time(
+            t, pulse, 0, peak, rise_low * amp
+        )
+    return output
+
+
+class WaveformFeatures:
+    '''
+    Pulse feature extraction on the jagged waveform branches of each chunk.
+
+    The features of all channels are computed in a single numba compiled pass,
+    and attached to the event as virtual branches named by the ``output``
+    pattern, e.g. amp_1, toa_1 for channel 1. The virtual branches can be
+    used in selections, weights and observables like any ntuple branch.
+
+    Available features: baseline, rms, amp, toa (constant fraction time of
+    arrival), risetime and charge (time integral of the baseline subtracted
+    pulse).
+    '''
+
+    def __init__(
+        self,
+        channels,
+        time="t{ch}",
+        voltage="w{ch}",
+        output="{feature}_{ch}",
+        polarity=1,
+        nbaseline=25,
+        cfd_fraction=0.5,
+        rise_fraction=(0.1, 0.9),
+    ):
+        self.channels = list(channels)
+        self.time = time
+        self.voltage = voltage
+        self.output = output
+        self.polarity = polarity
+        self.nbaseline = nbaseline
+        self.cfd_fraction = cfd_fraction
+        self.rise_fraction = rise_fraction
+
+    @property
+    def input_branches(self):
+        branches = set()
+        for ch in self.channels:
+            branches.add(self.time.format(ch=ch))
+            branches.add(self.voltage.format(ch=ch))
+        return branches
+
+    @property
+    def output_branches(self):
+        return {
+            self.output.format(feature=feature, ch=ch)
+            for feature in FEATURES
+            for ch in self.channels
+        }
+
+    def compute(self, event):
+        '''
+        return dictionary of {branch name : feature array} for given chunk.
+        '''
+        times = []
+        volts = []
+        counts = []
+        for ch in self.channels:
+            t = event[self.time.format(ch=ch)]
+            v = event[self.voltage.format(ch=ch)]
+            nsample = ak.to_numpy(ak.num(v, axis=1))
+            if np.any(ak.to_numpy(ak.num(t, axis=1)) != nsample):
+                raise ValueError(f"time and voltage of channel {ch} differ in length")
+            times.append(ak.to_numpy(ak.flatten(t), allow_missing=False))
+            volts.append(ak.to_numpy(ak.flatten(v), allow_missing=False))
+            counts.append(nsample)
+        nevent = len(counts[0]) if counts else 0
+        offsets = np.zeros(nevent * len(counts) + 1, dtype=np.int64)
+        if counts:
+            np.cumsum(np.concatenate(counts), out=offsets[1:])
+        features = _waveform_features(
+            np.concatenate(times).astype(np.float64),
+            np.concatenate(volts).astype(np.float64),
+            offsets,
+            self.polarity,
+            self.nbaseline,
+            self.cfd_fraction,
+            *self.rise_fraction,
+        )
+        features = features.reshape(len(self.channels), nevent, len(FEATURES))
+        output = {}
+        for i, ch in enumerate(self.channels):
+            for j, feature in enumerate(FEATURES):
+                name = self.output.format(feature=feature, ch=ch)
+                output[name] = features[i, :, j]
+        return output
+
+    def __call__(self, event):
+        for name, value in self.compute(event).items():
+            event[name] = value
+        return event
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import pickle
+import socket
+import logging
+import tempfile
+
+from .utils import resolve_filename
+
+log = logging.getLogger(__name__)
+
+
+def add_merge(lhs, rhs):
+    '''
+    default merging of two partial results, e.g. ConfigMgr, Cutflow. Tuples
+    are merged element-wise, and None is treated as empty.
+    '''
+    if isinstance(lhs, tuple):
+        return tuple(add_merge(x, y) for x, y in zip(lhs, rhs))
+    if lhs is None or rhs is None:
+        return rhs if lhs is None else lhs
+    lhs.add(rhs)
+    return lhs
+
+
+class Shard:
+    def __init__(self, id, run, files, path=None):
+        self.id = id
+        self.run = run
+        self.files = files
+        self.path = path
+
+    def to_dict(self):
+        return {"id": self.id, "run": self.run, "files": self.files}
+
+
+class WorkQueue:
+    '''
+    Work queue on a shared filesystem, without any broker service.
+
+    The files are split into shards, each stored as a json file under the
+    queue directory. A shard moves from pending/ to leased/ when a worker
+    claims it, which is an atomic rename, so each claim succeeds for exactly
+    one worker. The worker keeps the lease by updating the modification time
+    of the leased file as it makes progress, and leases not renewed within
+    lease_time are moved back to pending/ by requeue_expired, so shards of
+    killed or hung workers are taken over by the others. A shard is finished
+    once its partial result is published in partial/, which is an exclusive
+    hard link, so results of a shard processed twice after an expired lease
+    are only counted once.
+    '''
+
+    def __init__(self, directory, lease_time=600.0):
+        self.directory = directory
+        self.lease_time = lease_time
+        self.worker_id = f"{socket.gethostname()}.{os.getpid()}"
+
+    def _dir(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def manifest(self):
+        return os.path.join(self.directory, "shards.json")
+
+    def _partial(self, shard_id):
+        return os.path.join(self._dir("partial"), f"{shard_id}.pkl")
+
+    def create(self, files, shard_size=1):
+        '''
+        shard the files grouped by run number from utils.resolve_filename.
+        raise ValueError if any file name cannot be parsed.
+        '''
+        if os.path.exists(self.manifest):
+            raise FileExistsError(f"work queue already exists in {self.directory}")
+        filesdict, _ = resolve_filename(files)
+        parsed = {f for run_files in filesdict.values() for f in run_files}
+        dropped = [f for f in files if f not in parsed]
+        if dropped:
+            raise ValueError(f"unable to parse {len(dropped)} files: {dropped}")
+        for name in ("pending", "leased", "done", "partial", "merge"):
+            os.makedirs(self._dir(name), exist_ok=True)
+        shard_ids = []
+        for run, run_files in sorted(filesdict.items()):
+            for i in range(0, len(run_files), shard_size):
+                shard = Shard(
+                    f"{len(shard_ids):06d}", run, run_files[i : i + shard_size]
+                )
+                self._write(
+                    os.path.join(self._dir("pending"), f"{shard.id}.json"), shard
+                )
+                shard_ids.append(shard.id)
+        self._write(self.manifest, shard_ids)
+        log.info(f"created {len(shard_ids)} shards in {self.directory}")
+        return shard_ids
+
+    def _write(self, path, obj):
+        '''
+        write json atomically, so readers never see partial content.
+        '''
+        if isinstance(obj, Shard):
+            obj = obj.to_dict()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(obj, f)
+        os.replace(tmp, path)
+
+    def shard_ids(self):
+        with open(self.manifest) as f:
+            return json.load(f)
+
+    def status(self):
+        '''
+        return number of shards in pending, leased, and finished.
+        '''
+        return {
+            "pending": len(os.listdir(self._dir("pending"))),
+            "leased": len(os.listdir(self._dir("leased"))),
+            "finished": len(
+                [x for x in os.listdir(self._dir("partial")) if x.endswith(".pkl")]
+            ),
+        }
+
+    def claim(self):
+        '''
+        claim next pending shard. return None if nothing is left to claim.
+        '''
+        self.requeue_expired()
+        for fname in sorted(os.listdir(self._dir("pending"))):
+            src = os.path.join(self._dir("pending"), fname)
+            dst = os.path.join(self._dir("leased"), fname)
+            try:
+                # rename keeps the modification time, so the pending file is
+                # touched first to not be seen as an expired lease.
+                os.utime(src)
+                os.rename(src, dst)
+                with open(dst) as f:
+                    shard = Shard(path=dst, **json.load(f))
+            except FileNotFoundError:
+                continue  # claimed by other worker, or requeued.
+            if os.path.exists(self._partial(shard.id)):
+                # finished by a worker whose lease had expired.
+                self._finish(shard)
+                continue
+            log.debug(f"{self.worker_id} claimed shard {shard.id}")
+            return shard
+        return None
+
+    def renew(self, shard):
+        try:
+            os.utime(shard.path)
+        except FileNotFoundError:
+            log.warning(f"{self.worker_id} lost the lease of shard {shard.id}")
+
+    def requeue_expired(self):
+        now = time.time()
+        for fname in os.listdir(self._dir("leased")):
+            path = os.path.join(self._dir("leased"), fname)
+            try:
+                expired = now - os.path.getmtime(path) > self.lease_time
+                if expired:
+                    os.rename(path, os.path.join(self._dir("pending"), fname))
+                    log.info(f"requeued expired shard {fname}")
+            except FileNotFoundError:
+                continue
+
+    def _finish(self, shard):
+        try:
+            os.rename(shard.path, os.path.join(self._dir("done"), f"{shard.id}.json"))
+        except FileNotFoundError:
+            pass  # requeued, will be skipped by the next claim.
+
+    def complete(self, shard, result):
+        '''
+        publish the partial result of the shard. return False if the shard
+        was already completed by other worker.
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self._dir("partial"), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            os.link(tmp, self._partial(shard.id))
+            published = True
+        except FileExistsError:
+            log.warning(f"shard {shard.id} was already completed")
+            published = False
+        finally:
+            os.remove(tmp)
+        self._finish(shard)
+        return published
+
+    def reduce(self, merge=add_merge, fanout=8):
+        '''
+        merge the partial results hierarchically, loading at most fanout
+        results at a time. Each level of the tree is stored in merge/.
+        '''
+        shard_ids = self.shard_ids()
+        if not shard_ids:
+            raise RuntimeError(f"no shard in the work queue {self.directory}")
+        missing = [x for x in shard_ids if not os.path.exists(self._partial(x))]
+        if missing:
+            raise RuntimeError(f"{len(missing)} shards are not finished yet.")
+        paths = [self._partial(x) for x in shard_ids]
+        level = 0
+        while len(paths) > 1:
+            level += 1
+            merged_paths = []
+            for i in range(0, len(paths), fanout):
+                result = _load(paths[i])
+                for path in paths[i + 1 : i + fanout]:
+                    result = merge(result, _load(path))
+                path = os.path.join(self._dir("merge"), f"L{level}_{i//fanout:06d}.pkl")
+                with open(path, "wb") as f:
+                    pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+                merged_paths.append(path)
+            paths = merged_paths
+            log.info(f"merged level {level}: {len(paths)} results")
+        return _load(paths[0])
+
+
+def _load(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def run_worker(queue, make_config, make_histmaker=None, wait=True, poll=None):
+    '''
+    process shards until the queue is empty. With wait, keep polling while
+    shards are leased by other workers, to take over the stalled ones once
+    their leases expire.
+
+    The lease is renewed at every chunk processed by the histmaker, so each
+    chunk must take less than the lease time of the queue. The partial result
+    of each shard is the tuple (config, histmaker.cutflow), and
+    queue.reduce() returns the merged tuple.
+
+    queue : WorkQueue
+    make_config : callable taking list of files, and returning the
+        collinearw.ConfigMgr to be filled for these files.
+    make_histmaker : callable returning a new histmaker for each shard,
+        default to SSRLHistMaker.
+    poll : seconds between polling, default to 1/10 of the lease time.
+
+    return number of shards completed by this worker.
+    '''
+    if make_histmaker is None:
+        from .histmaker import SSRLHistMaker
+
+        make_histmaker = SSRLHistMaker
+    ncompleted = 0
+    while True:
+        shard = queue.claim()
+        if shard is None:
+            if wait and queue.status()["leased"]:
+                time.sleep(poll or queue.lease_time / 10.0)
+                continue
+            break
+        # new histmaker per shard, so no state is carried between shards.
+        histmaker = make_histmaker()
+        histmaker.progress_callback = lambda: queue.renew(shard)
+        config = make_config(shard.files)
+        queue.renew(shard)
+        histmaker.process(config)
+        ncompleted += queue.complete(shard, (config, histmaker.cutflow))
+    return ncompleted
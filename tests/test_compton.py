@@ -0,0 +1,88 @@
+import copy
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from pyssrl import compton
+
+PHOTON_E = 35e3
+ACCEPTANCE = (1.021 - 0.066, 1.021 + 0.066)
+
+
+def make_hist(nbins=40, xmin=0.0, xmax=5.0):
+    '''
+    minimal histogram providing the binning in keV.
+    '''
+    bins = np.linspace(xmin, xmax, nbins + 1)
+    return SimpleNamespace(
+        bins=bins, bin_content=np.zeros(nbins + 2), sumW2=np.zeros(nbins + 2)
+    )
+
+
+def compton_frac(photon_e):
+    ph = compton.photoelectric_xsec(photon_e)
+    xsec = compton.compton_xsec(photon_e)
+    return xsec / (ph + xsec)
+
+
+def test_template_normalization():
+    hist = make_hist()
+    full = compton.compton_template(PHOTON_E, hist, energy_unit=1e3)
+    assert full.bin_content.sum() == pytest.approx(1.0)
+    only = compton.compton_template(
+        PHOTON_E, hist, energy_unit=1e3, photoelectric=False, resolution=0.3
+    )
+    assert only.bin_content.sum() == pytest.approx(compton_frac(PHOTON_E))
+    accepted = compton.compton_template(
+        PHOTON_E,
+        hist,
+        acceptance_angles=ACCEPTANCE,
+        energy_unit=1e3,
+        photoelectric=False,
+    )
+    assert 0 < accepted.bin_content.sum() < compton_frac(PHOTON_E)
+    assert np.all(accepted.sumW2 == 0)
+
+
+@pytest.mark.parametrize(
+    "acceptance_angles, nsample", [(None, 20000), (ACCEPTANCE, 100000)]
+)
+def test_template_matches_sampling(acceptance_angles, nsample):
+    hist = make_hist()
+    template = compton.compton_template(
+        PHOTON_E,
+        hist,
+        acceptance_angles=acceptance_angles,
+        energy_unit=1e3,
+        photoelectric=False,
+    )
+    recoils = compton.kn_recoil_sampling(
+        PHOTON_E, N=nsample, acceptance_angles=acceptance_angles, seed=1
+    )
+    counts = np.bincount(np.digitize(recoils / 1e3, hist.bins), minlength=42)
+    expected = template.bin_content / template.bin_content.sum() * counts.sum()
+    assert np.all(np.abs(counts - expected) < 5 * np.sqrt(expected) + 5)
+
+
+def test_template_cache():
+    hist = make_hist()
+    first = compton.compton_template(PHOTON_E, hist, resolution=0.2, energy_unit=1e3)
+    reference = first.bin_content.copy()
+    first.bin_content[:] = 0.0
+    second = compton.compton_template(PHOTON_E, hist, resolution=0.2, energy_unit=1e3)
+    assert np.array_equal(second.bin_content, reference)
+    assert second is not first
+    assert np.all(hist.bin_content == 0)
+
+    content = compton._compton_template_content(
+        PHOTON_E,
+        tuple(hist.bins),
+        None,
+        0.2,
+        1e3,
+        True,
+        14,
+    )
+    assert not content.flags.writeable
+    assert copy.deepcopy(second).bin_content is not second.bin_content
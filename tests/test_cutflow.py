@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import awkward as ak
+import numpy as np
+
+from pyssrl.cutflow import Cutflow, split_selection
+
+
+def make_process(selection, regions):
+    return SimpleNamespace(
+        name="p",
+        selection_numexpr=selection,
+        regions=[
+            SimpleNamespace(name=name, selection_numexpr=sel) for name, sel in regions
+        ],
+    )
+
+
+def test_split_selection():
+    assert split_selection("((a>1)&(b<2 & (c|d)))") == ["a>1", "b<2 & (c|d)"]
+    assert split_selection("(a>1)|(b<2)&c") == ["(a>1)|(b<2)&c"]
+    assert split_selection("") == []
+
+
+def test_cutflow_counts_and_overlap():
+    event = ak.Array({"a": [0.1, 0.5, 0.8, 0.9], "b": [0.6, 0.7, 0.2, 0.9]})
+    p = make_process("a>0.2", [("r1", "(b>0.5)&(a<0.85)"), ("r2", "b<0.8")])
+    cutflow = Cutflow()
+    cutflow.fill(p, event, {"r1": 2.0})
+    rows = cutflow.rows("p", "r1")
+    assert [row[0] for row in rows] == ["all", "a>0.2", "b>0.5", "a<0.85"]
+    assert [row[1] for row in rows] == [4, 3, 2, 1]
+    assert [row[2] for row in rows] == [8.0, 6.0, 4.0, 2.0]
+    names, overlap = cutflow.overlap("p")
+    assert names == ["r1", "r2"]
+    assert np.array_equal(overlap, [[1, 1], [1, 2]])
+    assert "a>0.2" in cutflow.table("p", "r1")
+
+    merged = cutflow + cutflow
+    assert [row[1] for row in merged.rows("p", "r2")] == [8, 6, 4]
+
+
+def test_cutflow_jagged_selection_and_weights():
+    event = ak.Array({"x": [[1, 2], [], [5], [4, 0]], "w": [[2.0, 3.0], [], [4.0], []]})
+    p = make_process(None, [("r", "x>3")])
+    cutflow = Cutflow()
+    cutflow.fill(p, event, {"r": event["w"]})
+    rows = cutflow.rows("p", "r")
+    # an event passes if any object passes, weights are taken from the first
+    # object and events without object have zero weight.
+    assert [row[1] for row in rows] == [4, 2]
+    assert [row[2] for row in rows] == [6.0, 4.0]
+
+
+def test_cutflow_jagged_cuts_on_same_object():
+    event = ak.Array({"x": [[5, 1], [5, 1]], "y": [[5, 1], [1, 5]]})
+    p = make_process(None, [("r", "(x>3)&(y<2)")])
+    cutflow = Cutflow()
+    cutflow.fill(p, event)
+    # in the first event, x>3 and y<2 are passed by different objects.
+    assert [row[1] for row in cutflow.rows("p", "r")] == [2, 2, 1]
+    names, overlap = cutflow.overlap("p")
+    assert np.array_equal(overlap, [[1]])
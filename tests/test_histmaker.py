@@ -0,0 +1,118 @@
+import copy
+
+import awkward as ak
+import numpy as np
+import pytest
+
+pytest.importorskip("collinearw")
+
+from collinearw import Histogram  # noqa: E402
+from pyssrl.histmaker import AvgGraph, Graph, MultiWeightHisto1D  # noqa: E402
+
+
+def test_multiweight_constant_and_branch_variations():
+    event = ak.Array(
+        {
+            "x": [0.5, 1.5, 1.7, 4.2, 9.9, 12.0],
+            "eff": [1.0, 0.5, 2.0, 1.5, 0.1, 3.0],
+        }
+    )
+    hist = MultiWeightHisto1D(
+        "h", 10, 0, 10, "x", weight_variations={"cal_up": "1.05", "eff": "eff"}
+    )
+    factors = hist.variation_factors(event)
+    assert factors[0] == 1.05
+    hist.from_array(event["x"], 2.0, factors)
+
+    x = ak.to_numpy(event["x"])
+    eff = ak.to_numpy(event["eff"])
+    nominal = Histogram("n", 10, 0, 10, "x")
+    nominal.from_array(x, np.full(len(x), 2.0))
+    eff_ref = Histogram("e", 10, 0, 10, "x")
+    eff_ref.from_array(x, 2.0 * eff)
+
+    assert np.allclose(hist.bin_content, nominal.bin_content)
+    assert np.allclose(hist.sumW2, nominal.sumW2)
+    assert hist.variation_names == ["cal_up", "eff"]
+    assert np.allclose(hist.variation("cal_up").bin_content, 1.05 * nominal.bin_content)
+    assert np.allclose(hist.variation("eff").bin_content, eff_ref.bin_content)
+    assert np.allclose(hist.variation("eff").sumW2, eff_ref.sumW2)
+
+    merged = copy.deepcopy(hist)
+    merged.add(hist)
+    assert np.allclose(merged.variation_content, 2 * hist.variation_content)
+    assert np.allclose(merged.variation_sumW2, 2 * hist.variation_sumW2)
+
+
+def test_multiweight_default_variations():
+    hist = MultiWeightHisto1D(
+        "h", 10, 0, 10, "x", weight_variations={"up": "1.1", "dn": "0.9"}
+    )
+    hist.from_array(np.array([1.5, 2.5]))
+    assert np.allclose(hist.variation_content, hist.bin_content)
+    with pytest.raises(ValueError):
+        hist.from_array(np.array([1.5]), None, [1.0])
+
+
+def make_graph(seed=7, limit=10):
+    graph = Graph("g", "x", "y", "", "", "graph", sampling="reservoir", seed=seed)
+    graph.limit = limit
+    return graph
+
+
+def chunks(nchunk=20, size=50):
+    for i in range(nchunk):
+        ids = np.arange(i * size, (i + 1) * size)
+        yield (3, i * size), ak.Array([[x, x] for x in ids])
+
+
+def sample(graph):
+    return sorted(int(x[0]) for x in graph.xdata)
+
+
+def test_reservoir_is_reproducible():
+    first = make_graph()
+    second = make_graph()
+    for stream, data in chunks():
+        first.from_array(data, data, stream)
+        second.from_array(data, data, stream)
+    assert first.ndata == 10
+    assert first.counter == 1000
+    assert sample(first) == sample(second)
+
+
+def test_reservoir_merge_matches_single_stream():
+    single = make_graph()
+    lhs = make_graph()
+    rhs = copy.deepcopy(lhs)
+    for i, (stream, data) in enumerate(chunks()):
+        single.from_array(data, data, stream)
+        (lhs if i % 2 else rhs).from_array(data, data, stream)
+    merged = lhs + rhs
+    assert merged.counter == single.counter
+    assert sample(merged) == sample(single)
+
+
+def test_reservoir_skips_chunk_without_winner():
+    graph = make_graph()
+    for stream, data in chunks():
+        graph.from_array(data, data, stream)
+    # find a chunk whose keys are all larger than the ones in the reservoir.
+    stream = next(
+        (9, i)
+        for i in range(1000)
+        if np.random.default_rng([graph.seed, 9, i]).random(1)[0] > graph.keys.max()
+    )
+    xdata = graph.xdata
+    keys = graph.keys.copy()
+    data = ak.Array([[-1.0, -1.0]])
+    graph.from_array(data, data, stream)
+    assert graph.xdata is xdata
+    assert np.array_equal(graph.keys, keys)
+    assert graph.counter == 1001
+
+
+def test_avg_graph_rejects_reservoir():
+    AvgGraph("a", "x", "y", "", "", "avg-graph")
+    with pytest.raises(ValueError):
+        AvgGraph("a", "x", "y", "", "", "avg-graph", sampling="reservoir")
@@ -0,0 +1,59 @@
+import awkward as ak
+import numpy as np
+import pytest
+
+from pyssrl.waveform import FEATURES, WaveformFeatures
+
+
+def triangle(nsample, amp, offset=0.1, polarity=-1):
+    '''
+    pulse rising linearly from t=30 to the peak at t=40, and falling back to
+    the baseline at t=50, sampled at every unit of time.
+    '''
+    t = np.arange(nsample, dtype=float)
+    pulse = np.interp(t, [30, 40, 50], [0.0, amp, 0.0])
+    return t, offset + polarity * pulse
+
+
+def test_features_of_triangle_pulse():
+    t1, w1 = triangle(100, 2.0)
+    t2, w2 = triangle(60, 0.5)
+    event = ak.Array(
+        {
+            "t1": [t1, t1[:1]],
+            "w1": [w1, w1[:1]],
+            "t2": [t2, t2],
+            "w2": [w2, w2],
+        }
+    )
+    event = WaveformFeatures([1, 2], polarity=-1)(event)
+
+    assert event["baseline_1"][0] == pytest.approx(0.1)
+    assert event["rms_1"][0] == pytest.approx(0.0, abs=1e-12)
+    assert event["amp_1"][0] == pytest.approx(2.0)
+    assert event["toa_1"][0] == pytest.approx(35.0)
+    assert event["risetime_1"][0] == pytest.approx(8.0)
+    assert event["charge_1"][0] == pytest.approx(20.0)
+
+    assert np.allclose(ak.to_numpy(event["amp_2"]), 0.5)
+    assert np.allclose(ak.to_numpy(event["toa_2"]), 35.0)
+    assert np.allclose(ak.to_numpy(event["charge_2"]), 5.0)
+
+    # a waveform with less than 2 samples has no feature.
+    for feature in FEATURES:
+        assert np.isnan(event[f"{feature}_1"][1])
+
+
+def test_empty_chunk():
+    t, w = triangle(100, 1.0)
+    event = ak.Array({"t1": [t], "w1": [w]})[:0]
+    features = WaveformFeatures([1]).compute(event)
+    assert set(features) == {f"{feature}_1" for feature in FEATURES}
+    assert all(len(value) == 0 for value in features.values())
+
+
+def test_length_mismatch():
+    t, w = triangle(100, 1.0)
+    event = ak.Array({"t1": [t[:50]], "w1": [w]})
+    with pytest.raises(ValueError):
+        WaveformFeatures([1]).compute(event)
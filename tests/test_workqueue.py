@@ -0,0 +1,176 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from pyssrl.workqueue import WorkQueue, run_worker
+
+LEASE_TIME = 0.5
+
+
+class FakeConfig:
+    def __init__(self, files):
+        self.files = list(files)
+
+    def add(self, rhs):
+        self.files += rhs.files
+
+
+class FakeHistMaker:
+    '''
+    mimic SSRLHistMaker, processing each file as a chunk.
+    '''
+
+    def __init__(self):
+        self.cutflow = None
+        self.progress_callback = None
+
+    def process(self, config):
+        for _ in config.files:
+            self.progress_callback()
+            time.sleep(0.01)
+
+
+class HungHistMaker(FakeHistMaker):
+    def process(self, config):
+        time.sleep(3600)
+
+
+def make_files(nrun=3, nfile=10):
+    return [
+        f"/data/stats_Run{run}_LGAD_200V_35keV_note_{i}.root"
+        for run in range(nrun)
+        for i in range(nfile)
+    ]
+
+
+def worker(directory):
+    queue = WorkQueue(directory, lease_time=LEASE_TIME)
+    return run_worker(queue, FakeConfig, FakeHistMaker, poll=0.05)
+
+
+def hung_worker(directory):
+    queue = WorkQueue(directory, lease_time=LEASE_TIME)
+    return run_worker(queue, FakeConfig, HungHistMaker, poll=0.05)
+
+
+def stalled_claim(directory):
+    '''
+    claim a shard and die without completing it.
+    '''
+    WorkQueue(directory, lease_time=LEASE_TIME).claim()
+
+
+def run_workers(directory, nworker=3):
+    with multiprocessing.Pool(nworker) as pool:
+        return pool.map(worker, [directory] * nworker)
+
+
+def check_reduced(queue, files):
+    config, cutflow = queue.reduce(fanout=3)
+    assert sorted(config.files) == sorted(files)
+    assert cutflow is None
+
+
+def test_workers_take_over_killed_worker(tmp_path):
+    files = make_files()
+    queue = WorkQueue(str(tmp_path), lease_time=LEASE_TIME)
+    shard_ids = queue.create(files, shard_size=3)
+    assert len(shard_ids) == 12
+
+    dead = multiprocessing.Process(target=stalled_claim, args=(str(tmp_path),))
+    dead.start()
+    dead.join()
+    assert queue.status()["leased"] == 1
+
+    completed = run_workers(str(tmp_path))
+    assert sum(completed) == len(shard_ids)
+    assert queue.status() == {"pending": 0, "leased": 0, "finished": 12}
+    check_reduced(queue, files)
+
+
+def test_workers_take_over_hung_worker(tmp_path):
+    files = make_files()
+    queue = WorkQueue(str(tmp_path), lease_time=LEASE_TIME)
+    shard_ids = queue.create(files, shard_size=3)
+
+    hung = multiprocessing.Process(target=hung_worker, args=(str(tmp_path),))
+    hung.start()
+    try:
+        while queue.status()["leased"] == 0:
+            time.sleep(0.01)
+        start = time.time()
+        completed = run_workers(str(tmp_path))
+        assert time.time() - start < 30
+        assert hung.is_alive()
+    finally:
+        hung.kill()
+        hung.join()
+    assert sum(completed) == len(shard_ids)
+    check_reduced(queue, files)
+
+
+def test_duplicate_complete(tmp_path):
+    files = make_files(nrun=1, nfile=2)
+    queue = WorkQueue(str(tmp_path), lease_time=LEASE_TIME)
+    queue.create(files)
+
+    stale = queue.claim()
+    time.sleep(LEASE_TIME * 1.5)
+    # the lease of the stale worker expired, and the shard is claimed again.
+    shard = queue.claim()
+    assert shard.id == stale.id
+    assert queue.complete(shard, (FakeConfig(shard.files), None))
+    assert not queue.complete(stale, (FakeConfig(stale.files), None))
+
+    with pytest.raises(RuntimeError):
+        queue.reduce()
+    last = queue.claim()
+    assert queue.complete(last, (FakeConfig(last.files), None))
+    assert queue.claim() is None
+    check_reduced(queue, files)
+
+
+def test_create_rejects_unparsed_files(tmp_path):
+    queue = WorkQueue(str(tmp_path), lease_time=LEASE_TIME)
+    with pytest.raises(ValueError, match="unable to parse 1 files"):
+        queue.create(make_files(nrun=1, nfile=2) + ["/data/unknown.root"])
+    assert not (tmp_path / "shards.json").exists()
+
+
+def test_reduce_empty_queue(tmp_path):
+    queue = WorkQueue(str(tmp_path), lease_time=LEASE_TIME)
+    assert queue.create([]) == []
+    assert queue.claim() is None
+    with pytest.raises(RuntimeError, match="no shard"):
+        queue.reduce()
+
+
+def test_claim_old_pending_shard(tmp_path):
+    queue = WorkQueue(str(tmp_path), lease_time=LEASE_TIME)
+    queue.create(make_files(nrun=1, nfile=2))
+    # shards pending for longer than the lease time.
+    for path in (tmp_path / "pending").iterdir():
+        os.utime(path, (0, 0))
+    shard = queue.claim()
+    queue.requeue_expired()
+    assert queue.status()["leased"] == 1
+    assert queue.complete(shard, (FakeConfig(shard.files), None))
+
+
+def test_claim_requeued_during_claim(tmp_path, monkeypatch):
+    queue = WorkQueue(str(tmp_path), lease_time=LEASE_TIME)
+    queue.create(make_files(nrun=1, nfile=2))
+    rename = os.rename
+
+    def rename_then_requeue(src, dst):
+        # other node moves the shard back to pending right after the claim.
+        rename(src, dst)
+        if "leased" in str(dst):
+            rename(dst, src)
+
+    monkeypatch.setattr(os, "rename", rename_then_requeue)
+    assert queue.claim() is None
+    monkeypatch.undo()
+    assert queue.status()["pending"] == 2